@@ -29,17 +29,18 @@ Here's pseudo-code for invoking the pyspawner part::
         preload_imports=["pandas"],  # put all your slow imports here
     ) as cloner:
         # cloner.spawn_child() is fast; call it as many times as you like.
-        child_process: pyspawner.ChildProcess = cloner.spawn_child(
+        with cloner.spawn_child(
             args=["arg1", "arg2"],  # List of picklable Python objects
             process_name="child-1",
             sandbox_config=pyspawner.SandboxConfig(
                 chroot_dir=Path("/path/to/chroot/dir"),
                 network=pyspawner.NetworkConfig()
             )
-        )
-
-        # child_process has .pid, .stdin, .stdout, .stderr.
-        # Read from its stdout and stderr, and then wait for it.
+        ) as child_process:
+            # child_process has .pid, .stdin_fd, .stdout_fd, .stderr_fd (and
+            # .stdin, .stdout, .stderr file objects, opened on first access).
+            # Read from its stdout and stderr, and then wait for it. Leaving
+            # the "with" block closes its pipes.
 
 For each child, read from stdout and stderr until end-of-file; then wait() for
 the process to exit. Reading from two pipes at once is a standard exercise in
@@ -0,0 +1,44 @@
+"""
+Entry point for the pyspawner process.
+
+:class:`pyspawner.Client` runs ``python -u -m pyspawner._boot SOCKET_FD``. It
+passes ``child_main`` and the preload list in environment variables, so no
+user-supplied string is ever compiled as Python source.
+
+We delete those variables before spawning anything. Children inherit our
+environment, and it must be exactly the one the caller asked for.
+
+Children inherit our file descriptors, too. So we also close any fd our
+parent's process leaked to us.
+"""
+import os
+import sys
+
+from .main import pyspawner_main
+
+
+def _close_inherited_fds(keep_fd: int) -> None:
+    """
+    Close every inheritable fd except stdin, stdout, stderr and `keep_fd`.
+
+    Python opens its own fds non-inheritable (PEP 446), so an inheritable fd
+    must have come from our parent process. (The parent can't cheaply close
+    them for us: it may have thousands of fds open. We have a handful.)
+    """
+    for name in os.listdir("/proc/self/fd"):
+        fd = int(name)
+        if fd in (0, 1, 2, keep_fd):
+            continue
+        try:
+            if os.get_inheritable(fd):
+                os.close(fd)
+        except OSError:
+            pass  # the fd listdir() used, which is now closed
+
+
+if __name__ == "__main__":
+    socket_fd = int(sys.argv[1])
+    _close_inherited_fds(socket_fd)
+    child_main = os.environ.pop("PYSPAWNER_CHILD_MAIN")
+    preload_imports_str = os.environ.pop("PYSPAWNER_PRELOAD_IMPORTS")
+    pyspawner_main(child_main, preload_imports_str, socket_fd)
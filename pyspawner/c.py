@@ -1,4 +1,5 @@
 import ctypes
+import functools
 import os
 import signal
 import struct
@@ -150,6 +151,18 @@ def libc_prctl_pr_set_seccomp_mode_filter(bpf_bytes: bytes) -> None:
     _call_c_style(libc, "prctl", PR_SET_SECCOMP, SECCOMP_MODE_FILTER, sock_fprog, 0, 0)
 
 
+@functools.lru_cache(maxsize=None)
+def _c_callback(fn: Callable[[], None]) -> ctypes._CFuncPtr:
+    """
+    Wrap `fn` in a C function pointer, once.
+
+    pyspawner passes the same `run_child` to every `libc_clone()` call; this
+    saves building a new ctypes thunk per spawn. (The cache also keeps each
+    thunk alive, as ctypes requires while C may call it.)
+    """
+    return ctypes.PYFUNCTYPE(ctypes.c_int)(fn)
+
+
 def libc_clone(run_child: Callable[[], None]) -> int:
     """
     Spawn a subprocess that calls run_child().
@@ -167,12 +180,29 @@ def libc_clone(run_child: Callable[[], None]) -> int:
         * CLONE_NEWPID -- new PID namespace (children die when subprocess dies)
         * CLONE_NEWNET -- new network namespace (start with no Internet access)
         * signal.SIGCHLD -- send parent SIGCHLD on exit (the standard signal)
+
+    We deliberately do *not* pass CLONE_VM or CLONE_VFORK, even though they
+    would skip copying page tables:
+
+        * CLONE_VFORK suspends pyspawner until the child calls exec() or
+          exits. Our child never calls exec(): it runs child code in this
+          very Python interpreter. And before it sandboxes itself, it waits
+          for pyspawner to write its uid_map. So pyspawner and child would
+          deadlock.
+        * CLONE_VM would make the child share pyspawner's memory. Untrusted
+          child code could then rewrite pyspawner -- and through it, every
+          future child. The copy-on-write memory that clone() gives us is a
+          sandboxing layer.
+
+    The child stack, `_CHILD_STACK`, is already allocated once per pyspawner
+    lifetime. Each child writes to its own copy-on-write copy of it. (Reusing
+    it does not depend on vfork semantics: the pyspawner never touches the
+    stack area itself.)
     """
-    c_run_child = ctypes.PYFUNCTYPE(ctypes.c_int)(run_child)
     child_pid = _call_c_style(
         libc,
         "clone",
-        c_run_child,
+        _c_callback(run_child),
         _RUN_CHILD_STACK_POINTER,
         CLONE_PARENT
         | CLONE_NEWNS
@@ -1,44 +1,182 @@
+import collections
+import fcntl
+import itertools
 import os
+import queue
+import re
 import socket
-import subprocess
 import sys
 import threading
+import weakref
+from concurrent.futures import Future
 from dataclasses import dataclass
 from typing import Any, BinaryIO, Dict, List, Optional, Tuple
 
 from . import protocol
 
 
-@dataclass(frozen=True)
 class ChildProcess:
     """
     A handle for the parent to interact with a spawned child process.
 
     This is akin to a subprocess.Popen object ... but with fewer features.
     (Rationale: subprocess.Popen has too many features.)
-    """
 
-    pid: int
-    """
-    Child process ID as seen from the parent.
+    The child's pipes are raw file descriptors. :attr:`stdin`, :attr:`stdout`
+    and :attr:`stderr` wrap them in Python file objects the first time you
+    access them; callers that use :mod:`selectors` and :func:`os.read()` on
+    :attr:`stdout_fd` and :attr:`stderr_fd` never pay for those wrappers.
 
-    (The child process will see its own ID as ``1``.)
-    """
+    Close the pipes when you're done with them. The simplest way is to use
+    the child process as a context manager::
 
-    stdin: BinaryIO  # auto-closes in __del__
-    """
-    Writable pipe, readable in the child as ``sys.stdin``.
-    """
+        with cloner.spawn_child(args, sandbox_config=config) as child_process:
+            ...  # read stdout and stderr; then wait()
 
-    stdout: BinaryIO  # auto-closes in __del__
-    """
-    Readable pipe, written in the child as ``sys.stdout``.
+    ... which calls :meth:`close()` on exit. (If you forget, we close the
+    pipes when the ChildProcess is garbage-collected.)
     """
 
-    stderr: BinaryIO  # auto-closes in __del__
-    """
-    Readable pipe, written in the child as ``sys.stderr``.
-    """
+    # Callers may spawn thousands of children: skip the per-instance __dict__
+    __slots__ = (
+        "pid",
+        "stdin_fd",
+        "stdout_fd",
+        "stderr_fd",
+        "_stdin",
+        "_stdout",
+        "_stderr",
+        "_stdin_fd_closed",
+        "_closed",
+    )
+
+    def __init__(self, pid: int, stdin_fd: int, stdout_fd: int, stderr_fd: int):
+        self.pid = pid
+        """
+        Child process ID as seen from the parent.
+
+        (The child process will see its own ID as ``1``.)
+        """
+
+        self.stdin_fd = stdin_fd
+        """
+        Writable pipe file descriptor, readable in the child as ``sys.stdin``.
+        """
+
+        self.stdout_fd = stdout_fd
+        """
+        Readable pipe file descriptor, written in the child as ``sys.stdout``.
+
+        (With ``memfd_output``, this is a read-only memfd instead of a pipe.)
+        """
+
+        self.stderr_fd = stderr_fd
+        """
+        Readable pipe file descriptor, written in the child as ``sys.stderr``.
+
+        (With ``memfd_output``, this is a read-only memfd instead of a pipe.)
+        """
+
+        self._stdin: Optional[BinaryIO] = None
+        self._stdout: Optional[BinaryIO] = None
+        self._stderr: Optional[BinaryIO] = None
+        self._stdin_fd_closed = False  # by send_stdin_and_close(), unwrapped
+        self._closed = False
+
+    @property
+    def stdin(self) -> BinaryIO:
+        """
+        Writable pipe, readable in the child as ``sys.stdin``.
+
+        (Opened from :attr:`stdin_fd` on first access.)
+        """
+        if self._closed or self._stdin_fd_closed:
+            raise ValueError("I/O operation on closed file")
+        if self._stdin is None:
+            self._stdin = os.fdopen(self.stdin_fd, mode="wb")
+        return self._stdin
+
+    @property
+    def stdout(self) -> BinaryIO:
+        """
+        Readable pipe, written in the child as ``sys.stdout``.
+
+        (Opened from :attr:`stdout_fd` on first access.)
+        """
+        if self._closed:
+            raise ValueError("I/O operation on closed file")
+        if self._stdout is None:
+            self._stdout = os.fdopen(self.stdout_fd, mode="rb")
+        return self._stdout
+
+    @property
+    def stderr(self) -> BinaryIO:
+        """
+        Readable pipe, written in the child as ``sys.stderr``.
+
+        (Opened from :attr:`stderr_fd` on first access.)
+        """
+        if self._closed:
+            raise ValueError("I/O operation on closed file")
+        if self._stderr is None:
+            self._stderr = os.fdopen(self.stderr_fd, mode="rb")
+        return self._stderr
+
+    def send_stdin_and_close(self, data: bytes) -> None:
+        """
+        Write all of `data` to the child's stdin, then close stdin.
+
+        This writes straight to :attr:`stdin_fd`, without wrapping it in a
+        file object. It blocks until the child has read all but the last
+        pipe-buffer's worth of `data`.
+
+        :raises BrokenPipeError: if the child closed its stdin (or died).
+        :raises ValueError: if stdin is already closed.
+        """
+        if self._closed or self._stdin_fd_closed:
+            raise ValueError("I/O operation on closed file")
+        if self._stdin is None:
+            self._stdin_fd_closed = True  # close() must not close the fd again
+            try:
+                protocol.write_all(self.stdin_fd, data)
+            finally:
+                os.close(self.stdin_fd)
+        else:
+            with self._stdin:
+                self._stdin.write(data)
+
+    def close(self) -> None:
+        """
+        Close stdin, stdout and stderr.
+
+        This closes file objects that were opened from the pipes; and it calls
+        :func:`os.close()` on any file descriptor that was never wrapped. It is
+        safe to call more than once.
+
+        Do not call :func:`os.close()` on :attr:`stdin_fd`, :attr:`stdout_fd`
+        or :attr:`stderr_fd` yourself: this method would close them again,
+        and by then the numbers may belong to other files.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        pipes = [(self._stdout, self.stdout_fd), (self._stderr, self.stderr_fd)]
+        if not self._stdin_fd_closed:
+            pipes.append((self._stdin, self.stdin_fd))
+        for fileobj, fd in pipes:
+            if fileobj is None:
+                os.close(fd)
+            else:
+                fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        self.close()
 
     def kill(self) -> None:
         """
@@ -57,9 +195,76 @@ class ChildProcess:
         return os.waitpid(self.pid, options)
 
 
+_ILLEGAL_MODULE_NAME_CHARS = re.compile(r'[",\s]')
+
+_SOCKET_FD = 3
+"""The pyspawner's end of the control socket, as numbered in the pyspawner."""
+
+
+@dataclass(frozen=True)
+class _PyspawnerProcess:
+    """
+    The pyspawner process, as launched by `os.posix_spawnp()`.
+    """
+
+    pid: int
+
+    def wait(self) -> int:
+        """
+        Wait for the pyspawner to exit; return its wait status.
+        """
+        _, status = os.waitpid(self.pid, 0)
+        return status
+
+
+_BUILTIN_SCALAR_TYPES = frozenset(
+    {str, bytes, bytearray, int, float, complex, bool, type(None)}
+)
+_BUILTIN_CONTAINER_TYPES = frozenset({list, tuple, set, frozenset})
+_MAX_PREWARM_ARGS_OBJECTS = 1000
+
+
+def _unpickles_without_imports(obj: Any) -> bool:
+    """
+    Return True if unpickling `obj` can't import a module.
+
+    A prewarmed child unpickles its args after sandboxing, when imports may
+    fail. A pickle of builtin scalars and containers refers to no module.
+
+    Return False -- so the caller clones, which is always safe -- if `obj`
+    holds more than `_MAX_PREWARM_ARGS_OBJECTS` objects (checking them all
+    could cost more than the clone), or if it holds the same container twice
+    (which may be a cycle).
+    """
+    budget = _MAX_PREWARM_ARGS_OBJECTS - 1  # `obj` itself is one
+    seen_ids = set()
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        t = type(item)
+        if t in _BUILTIN_SCALAR_TYPES:
+            continue
+        if t is dict:
+            budget -= 2 * len(item)
+        elif t in _BUILTIN_CONTAINER_TYPES:
+            budget -= len(item)
+        else:
+            return False
+        if budget < 0 or id(item) in seen_ids:
+            return False
+        seen_ids.add(id(item))
+        if t is dict:
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        else:
+            stack.extend(item)
+    return True
+
+
 def _encode_module_name_list(l: List[str]) -> str:
+    l = list(l)  # we iterate twice: a generator would be empty the second time
     for s in l:
-        if '"' in s or "," in s or " " in s:
+        if _ILLEGAL_MODULE_NAME_CHARS.search(s):
             raise ValueError("Module name %r is illegal" % s)
     return ",".join(l)
 
@@ -96,9 +301,14 @@ class Client:
       is fast; and multiprocessing and asyncio have a race in Python 3.7.4 that
       causes forkserver children to exit with status code 255, so their
       named-pipe+hmac approach does not inspire confidence.)
+    * Pipelined: a writer thread sends requests as soon as callers queue them,
+      and a reader thread hands each response to the caller waiting for it.
+      While the pyspawner clones one child, callers can pickle and send their
+      next requests.
 
     :param child_main: The full name (including module name) of the function
-                       each child should run. (Must be importable.)
+                       each child should run. (Must be importable.) It may be
+                       nested: for instance, ``"mymodule.MyClass.main"``.
     :param environment: Environment variables for child processes. (Must all
                         be str.)
     :param preload_imports: List of module names pyspawner should import at
@@ -106,6 +316,29 @@ class Client:
                             imports) will be preloaded in all child processes.
     :param executable: Python executable to invoke. (Default: current-process
                        executable).
+    :param enable_process_names: If False, ignore the ``process_name`` passed
+                                 to :meth:`spawn_child()`. Children keep the
+                                 pyspawner's process name, and spawning skips
+                                 a ``prctl()`` call.
+    :param prewarm: Number of children to keep spawned and sandboxed ahead of
+                    time, each waiting for its ``args``. A call to
+                    :meth:`spawn_child()` with ``prewarm_sandbox_config``
+                    (and no ``memfd_output``) takes one of these children and
+                    writes ``args`` to it, instead of waiting for a clone().
+                    A background thread replaces the children it takes. Each
+                    idle child costs memory. Beware: a prewarmed child
+                    unpickles ``args`` *after* sandboxing (and chroot), when
+                    it may not be able to import anything. So only ``args``
+                    made of builtin types (str, bytes, int, float, bool,
+                    None, and lists, tuples, dicts and sets of those) use the
+                    pool, and only up to 1,000 objects, with no container
+                    appearing twice. Other ``args`` -- a ``Fraction``, a numpy
+                    array, a recursive list -- make :meth:`spawn_child()`
+                    clone as usual.
+    :param prewarm_sandbox_config: Sandbox settings for prewarmed children.
+                                   (Must not enable networking: every child
+                                   with a network gets the same interface
+                                   names, so only one may run at a time.)
     """
 
     def __init__(
@@ -115,33 +348,206 @@ class Client:
         environment: Dict[str, str] = {},
         preload_imports: List[str] = [],
         executable: str = sys.executable,
+        enable_process_names: bool = True,
+        prewarm: int = 0,
+        prewarm_sandbox_config: protocol.SandboxConfig = protocol.SandboxConfig(),
     ):
-        # We rely on Python's os.fork() internals to close FDs and run a child
-        # process.
+        if prewarm and prewarm_sandbox_config.network is not None:
+            raise ValueError("prewarm_sandbox_config must not enable networking")
+
+        # posix_spawn(), not fork(): our caller may be huge, and copying its
+        # page tables just to exec() Python would be a waste.
         self._socket, child_socket = socket.socketpair(socket.AF_UNIX)
-        self._process = subprocess.Popen(
+        if child_socket.fileno() <= _SOCKET_FD:
+            # Our caller closed stdin, stdout or stderr. Move the socket clear
+            # of our file actions. (dup2() onto itself would keep O_CLOEXEC.)
+            fd = fcntl.fcntl(child_socket, fcntl.F_DUPFD_CLOEXEC, _SOCKET_FD + 1)
+            child_socket.close()
+            child_socket = socket.socket(fileno=fd)
+        # child_socket stays non-inheritable here, so a process another thread
+        # spawns can't inherit it; dup2() clears O_CLOEXEC in the pyspawner
+        # alone. Python opens every other fd with O_CLOEXEC (PEP 446), so the
+        # pyspawner inherits only stdin, stdout, stderr and this socket --
+        # plus any fd our caller made inheritable. (pyspawner._boot closes
+        # those. Enumerating them here would cost us a /proc scan.)
+        pid = os.posix_spawnp(
+            executable,
             [
                 executable,
                 "-u",  # PYTHONUNBUFFERED: parents read children's data sooner
-                "-c",
-                'import pyspawner.main; pyspawner.main.pyspawner_main("%s", "%s", %d)'
-                % (
-                    child_main,
-                    _encode_module_name_list(preload_imports),
-                    child_socket.fileno(),
-                ),
+                "-m",
+                "pyspawner._boot",
+                str(_SOCKET_FD),
+            ],
+            # SECURITY: children inherit these values. (pyspawner._boot deletes
+            # the PYSPAWNER_* variables before spawning any children.)
+            {
+                **environment,
+                "PYSPAWNER_CHILD_MAIN": child_main,
+                "PYSPAWNER_PRELOAD_IMPORTS": _encode_module_name_list(preload_imports),
+            },
+            file_actions=[
+                (os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+                (os.POSIX_SPAWN_DUP2, sys.stdout.fileno(), 1),
+                (os.POSIX_SPAWN_DUP2, sys.stderr.fileno(), 2),
+                (os.POSIX_SPAWN_DUP2, child_socket.fileno(), _SOCKET_FD),
             ],
-            # SECURITY: children inherit these values
-            env=environment,
-            stdin=subprocess.DEVNULL,
-            stdout=sys.stdout.fileno(),
-            stderr=sys.stderr.fileno(),
-            close_fds=True,
-            pass_fds=[child_socket.fileno()],
+            # Unblock all signals, even if the calling thread blocks some.
+            # (Children inherit the pyspawner's signal mask.)
+            setsigmask=(),
         )
+        self._process = _PyspawnerProcess(pid)
+        self._enable_process_names = enable_process_names
         child_socket.close()
-        self._lock = threading.Lock()
+
+        self._lock = threading.Lock()  # guards _closed, _eof, _pending, _prewarmed
         self._closed = False
+        self._eof = threading.Event()  # the pyspawner hung up (exited or crashed)
+        self._pending: Dict[int, Future] = {}
+        self._prewarm = prewarm
+        self._prewarm_sandbox_config = prewarm_sandbox_config
+        self._prewarmed: collections.deque = collections.deque()
+        self._prewarm_needed = threading.Event()  # wakes _prewarm_thread
+        self._seqs = itertools.count()
+        self._send_queue: queue.SimpleQueue = queue.SimpleQueue()
+        # Our threads must not refer to `self`: then, if our caller forgets to
+        # call close(), garbage collection still stops the pyspawner.
+        self._writer_thread = threading.Thread(
+            target=self._write_requests,
+            args=(self._socket, self._send_queue, self._lock, self._pending),
+            name="pyspawner-writer",
+            daemon=True,
+        )
+        self._reader_thread = threading.Thread(
+            target=self._read_responses,
+            args=(self._socket, self._lock, self._pending, self._eof),
+            name="pyspawner-reader",
+            daemon=True,
+        )
+        self._writer_thread.start()
+        self._reader_thread.start()
+        if prewarm:
+            self._prewarm_thread = threading.Thread(
+                target=self._refill_prewarmed,
+                args=(weakref.ref(self), self._prewarm_needed),
+                name="pyspawner-prewarm",
+                daemon=True,
+            )
+            self._prewarm_thread.start()
+        else:
+            self._prewarm_thread = None
+        self._stop_threads = weakref.finalize(
+            self, self._request_stop, self._send_queue, self._prewarm_needed
+        )
+
+    @staticmethod
+    def _request_stop(
+        send_queue: queue.SimpleQueue, prewarm_needed: threading.Event
+    ) -> None:
+        """
+        Make our threads exit, and (eventually) the pyspawner too.
+
+        Called by `close()`, or when the Client is garbage-collected.
+        """
+        prewarm_needed.set()
+        send_queue.put(None)  # writer shuts down the socket's write side
+
+    @staticmethod
+    def _write_requests(
+        sock: socket.socket,
+        send_queue: queue.SimpleQueue,
+        lock: threading.Lock,
+        pending: Dict[int, Future],
+    ) -> None:
+        """
+        Send queued requests to the pyspawner, in order.
+
+        Runs in `self._writer_thread` until `_request_stop()` queues `None`.
+        """
+        while True:
+            item = send_queue.get()
+            if item is None:
+                # inspire self._process to exit of its own accord
+                sock.shutdown(socket.SHUT_WR)
+                return
+            seq, chunks, future = item
+            try:
+                protocol.sendmsg_all(sock, chunks)
+            except OSError as err:
+                with lock:
+                    # The reader may already have failed it, at EOF
+                    if pending.pop(seq, None) is not None:
+                        future.set_exception(err)
+
+    @staticmethod
+    def _read_responses(
+        sock: socket.socket,
+        lock: threading.Lock,
+        pending: Dict[int, Future],
+        eof: threading.Event,
+    ) -> None:
+        """
+        Hand each SpawnedChild response to the caller waiting for it.
+
+        Runs in `self._reader_thread` until the pyspawner closes its socket.
+        Then fails every pending request with EOFError.
+        """
+        while True:
+            try:
+                response = protocol.SpawnedChild.recv_on_socket(sock)
+            except (protocol.ProtocolError, OSError):
+                break
+            if response is None:
+                break
+            with lock:
+                future = pending.pop(response.seq, None)
+            if future is None:
+                # Nobody asked for this child. Don't leak its pipes.
+                for fd in (response.stdin_fd, response.stdout_fd, response.stderr_fd):
+                    os.close(fd)
+            else:
+                future.set_result(response)
+
+        with lock:
+            eof.set()
+            futures = list(pending.values())
+            pending.clear()
+        for future in futures:
+            future.set_exception(EOFError("pyspawner closed its socket"))
+
+    @staticmethod
+    def _refill_prewarmed(
+        client_ref: "weakref.ref[Client]", prewarm_needed: threading.Event
+    ) -> None:
+        """
+        Keep `client._prewarm` idle children in `client._prewarmed`.
+
+        Runs in `self._prewarm_thread` until `close()` or garbage collection,
+        or until spawning fails. (Then `spawn_child()` finds the pool empty
+        and clones.) It only refers to the Client while it spawns.
+        """
+        while True:
+            client = client_ref()
+            if client is None or client._closed:
+                return
+            with client._lock:
+                n_missing = client._prewarm - len(client._prewarmed)
+            for _ in range(n_missing):
+                try:
+                    child = client._spawn(
+                        args=[],
+                        process_name=None,
+                        sandbox_config=client._prewarm_sandbox_config,
+                        memfd_output=False,
+                        args_from_stdin=True,
+                    )
+                except (RuntimeError, EOFError, OSError):
+                    return
+                with client._lock:
+                    client._prewarmed.append(child)
+            del client
+            prewarm_needed.wait()
+            prewarm_needed.clear()
 
     def __enter__(self):
         return self
@@ -155,6 +561,7 @@ class Client:
         *,
         process_name: Optional[str] = None,
         sandbox_config: protocol.SandboxConfig,
+        memfd_output: bool = False,
     ) -> ChildProcess:
         """
         Make our server spawn a process, and return it.
@@ -163,24 +570,98 @@ class Client:
                      (Must be picklable.)
         :param process_name: Process name to display for the child process in
                              ``ps`` and other sysadmin tools. (Useful for
-                             debugging.)
+                             debugging. Ignored if the Client was created with
+                             ``enable_process_names=False``.)
         :param sandbox_config: Sandbox settings.
         :type sandbox_config: pyspawner.SandboxConfig
+        :param memfd_output: If set, the child writes stdout and stderr to
+                             in-memory files (see :func:`os.memfd_create()`)
+                             instead of pipes. The child never blocks on
+                             writes; the parent reads all output in one go
+                             after :meth:`ChildProcess.wait()`. (Reading before
+                             the child exits returns only what it has written
+                             so far.) Beware: nothing limits how much memory
+                             the child's output consumes.
         :raises OSError: if the clone() system call fails.
         :raises pyroute2.NetlinkError: if network configuration fails.
         :rtype: pyspawner.ChildProcess
+
+        If the Client was created with ``prewarm``, ``sandbox_config`` equals
+        its ``prewarm_sandbox_config``, ``memfd_output`` is False and
+        ``args`` are a few builtin types, this returns an idle prewarmed child
+        without a round-trip to the pyspawner. (If the pool is empty, it
+        clones as usual.)
+        """
+        if not self._enable_process_names:
+            process_name = None
+        if (
+            self._prewarm
+            and not memfd_output
+            and sandbox_config == self._prewarm_sandbox_config
+            and _unpickles_without_imports(args)
+        ):
+            payload = protocol.ChildArgs(args, process_name).encode()
+            while True:
+                with self._lock:
+                    if not self._prewarmed:
+                        break  # the pool is empty: clone
+                    child = self._prewarmed.popleft()
+                self._prewarm_needed.set()
+                try:
+                    protocol.write_all(child.stdin_fd, payload)
+                except BrokenPipeError:
+                    # The idle child died (someone killed it?). Try the next.
+                    child.close()
+                    child.wait(0)
+                    continue
+                return child
+
+        return self._spawn(
+            args=args,
+            process_name=process_name,
+            sandbox_config=sandbox_config,
+            memfd_output=memfd_output,
+            args_from_stdin=False,
+        )
+
+    def _spawn(
+        self,
+        *,
+        args: List[Any],
+        process_name: Optional[str],
+        sandbox_config: protocol.SandboxConfig,
+        memfd_output: bool,
+        args_from_stdin: bool,
+    ) -> ChildProcess:
+        """
+        Ask the pyspawner to clone a child; wait for its response.
         """
+        # Wrap: seq is 32 bits on the wire. (Long before 2**32 spawns, the
+        # request that last used this seq has been answered.)
+        seq = next(self._seqs) & 0xFFFFFFFF
         message = protocol.SpawnChild(
-            process_name=process_name, args=args, sandbox_config=sandbox_config
+            seq=seq,
+            process_name=process_name,
+            args=args,
+            sandbox_config=sandbox_config,
+            memfd_output=memfd_output,
+            args_from_stdin=args_from_stdin,
         )
+        chunks = message.encode()  # pickle in the calling thread
+        future = Future()
         with self._lock:
-            message.send_on_socket(self._socket)
-            response = protocol.SpawnedChild.recv_on_socket(self._socket)
+            if self._closed:
+                raise RuntimeError("This pyspawner.Client is closed")
+            if self._eof.is_set():
+                raise EOFError("pyspawner closed its socket")
+            self._pending[seq] = future
+        self._send_queue.put((seq, chunks, future))
+        response = future.result()  # raise EOFError, OSError
         return ChildProcess(
             pid=response.pid,
-            stdin=os.fdopen(response.stdin_fd, mode="wb"),
-            stdout=os.fdopen(response.stdout_fd, mode="rb"),
-            stderr=os.fdopen(response.stderr_fd, mode="rb"),
+            stdin_fd=response.stdin_fd,
+            stdout_fd=response.stdout_fd,
+            stderr_fd=response.stderr_fd,
         )
 
     def close(self) -> None:
@@ -188,10 +669,20 @@ class Client:
         Kill the pyspawner.
 
         Spawned child processes continue to run: they are entirely disconnected
-        from their pyspawner.
+        from their pyspawner. Idle prewarmed children exit.
         """
         with self._lock:
-            if not self._closed:
-                self._socket.close()  # inspire self._process to exit of its own accord
-                self._process.wait()
-                self._closed = True
+            if self._closed:
+                return
+            self._closed = True
+        self._stop_threads()
+        self._writer_thread.join()
+        self._reader_thread.join()  # reader reads until pyspawner exits
+        if self._prewarm_thread is not None:
+            self._prewarm_thread.join()
+        for child in self._prewarmed:
+            child.close()  # the child reads EOF on stdin, and exits
+            child.wait(0)
+        self._prewarmed.clear()
+        self._socket.close()
+        self._process.wait()
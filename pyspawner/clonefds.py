@@ -2,6 +2,19 @@ from __future__ import annotations
 
 import os
 from dataclasses import dataclass
+from typing import Tuple
+
+
+def _memfd_pair(name: str) -> Tuple[int, int]:
+    """
+    Create a memfd; return `(read_fd, write_fd)`, like `os.pipe()`.
+
+    `read_fd` is a second open file of the same memfd, so its offset does not
+    move when the child writes through `write_fd`.
+    """
+    write_fd = os.memfd_create(name, os.MFD_CLOEXEC)
+    read_fd = os.open("/proc/self/fd/%d" % write_fd, os.O_RDONLY | os.O_CLOEXEC)
+    return read_fd, write_fd
 
 
 @dataclass(frozen=True)
@@ -67,10 +80,22 @@ class CloneFds:
     is_namespace_ready_w: int
 
     @classmethod
-    def create(cls) -> CloneFds:
+    def create(cls, *, memfd_output: bool = False) -> CloneFds:
+        """
+        Open all file descriptors.
+
+        If `memfd_output` is set, stdout and stderr are memfds rather than
+        pipes: the child writes without ever blocking, and the parent reads
+        everything after the child exits. Each `*_r` is a separate, read-only
+        open file of its memfd, starting at offset 0.
+        """
         stdin_r, stdin_w = os.pipe()
-        stdout_r, stdout_w = os.pipe()
-        stderr_r, stderr_w = os.pipe()
+        if memfd_output:
+            stdout_r, stdout_w = _memfd_pair("stdout")
+            stderr_r, stderr_w = _memfd_pair("stderr")
+        else:
+            stdout_r, stdout_w = os.pipe()
+            stderr_r, stderr_w = os.pipe()
         is_namespace_ready_r, is_namespace_ready_w = os.pipe()
         return cls(
             stdin_r,
@@ -1,4 +1,5 @@
 import importlib
+import operator
 import os
 import socket
 import sys
@@ -38,12 +39,17 @@ def run_child() -> None:
     process_name = message.process_name
     sandbox_config = message.sandbox_config
     args = message.args
+    args_from_stdin = message.args_from_stdin
     message = None
 
     # Close `sock`.
     # SECURITY: if we forget this, the child could read all the parent's
     # messages! It's super-important.
-    os.close(sock.fileno())
+    #
+    # detach() first, so the socket object forgets the fd number. Otherwise
+    # the object would still hold it after the fd is closed and possibly
+    # reused by child code.
+    os.close(sock.detach())
     sock = None
 
     # Set process name seen in "ps". Helps find PID when debugging.
@@ -65,6 +71,16 @@ def run_child() -> None:
     # Sandbox ourselves.
     sandbox_child_self(sandbox_config)
 
+    # A prewarmed child waits -- sandboxed -- for the parent to hand it work.
+    if args_from_stdin:
+        child_args = protocol.ChildArgs.read_from_fd(0)  # raise ProtocolError
+        if child_args is None:
+            os._exit(0)  # the parent closed our stdin: it won't need us
+        if child_args.process_name:
+            c.libc_prctl_pr_set_name(child_args.process_name)
+        args = child_args.args
+        child_args = None
+
     # Run the child code. This is what it's all about!
     #
     # It's normal for child code to raise an exception. That's probably a
@@ -105,9 +121,9 @@ def spawn_child(sock: socket.socket, message: protocol.SpawnChild) -> None:
     * "child": invokes `child_main()`.
     """
     global clone_fds
-    assert clone_fds is None  # previous spawn_child() cleaned up after itself
-
-    clone_fds = clonefds.CloneFds.create()
+    # clone_fds is None here: the previous spawn_child() set it to None on its
+    # way out (and pyspawner_main() calls us one at a time).
+    clone_fds = clonefds.CloneFds.create(memfd_output=message.memfd_output)
 
     try:
         child_pid = c.libc_clone(run_child)
@@ -147,7 +163,11 @@ def spawn_child(sock: socket.socket, message: protocol.SpawnChild) -> None:
 
     # Send our lovely new process to the caller (parent process)
     spawned_child = protocol.SpawnedChild(
-        child_pid, parent_fds.stdin_w, parent_fds.stdout_r, parent_fds.stderr_r
+        message.seq,
+        child_pid,
+        parent_fds.stdin_w,
+        parent_fds.stdout_r,
+        parent_fds.stderr_r,
     )
     spawned_child.send_on_socket(sock)
 
@@ -155,6 +175,30 @@ def spawn_child(sock: socket.socket, message: protocol.SpawnChild) -> None:
     clone_fds = None
 
 
+def _import_child_main(name: str) -> Callable[..., None]:
+    """
+    Import a function by its full name.
+
+    The name is a module name followed by a dotted attribute path: for
+    instance, "mymodule.main" or "mypackage.mymodule.MyClass.main". We import
+    the longest prefix of `name` that is a module.
+    """
+    parts = name.split(".")
+    if len(parts) < 2:
+        raise ValueError("child_main %r must include a module name" % name)
+    for i in range(len(parts) - 1, 0, -1):
+        module_name = ".".join(parts[:i])
+        try:
+            module = importlib.import_module(module_name)
+        except ModuleNotFoundError as err:
+            if i > 1 and (
+                module_name == err.name or module_name.startswith(err.name + ".")
+            ):
+                continue  # `module_name` isn't a module; try a shorter prefix
+            raise
+        return operator.attrgetter(".".join(parts[i:]))(module)
+
+
 def pyspawner_main(_child_main: str, preload_imports_str: str, socket_fd: int) -> None:
     """
     Start the pyspawner.
@@ -162,8 +206,8 @@ def pyspawner_main(_child_main: str, preload_imports_str: str, socket_fd: int) -
     The init protocol ("a" means "parent" [class Pyspawner], "b" means,
     "pyspawner" [pyspawner_main()]; "c" means, "child" [run_child()]):
 
-    1a. Parent invokes pyspawner_main(), passing imports and AF_UNIX fd as
-        arguments.
+    1a. Parent invokes pyspawner_main() (via `python -m pyspawner._boot`),
+        passing imports and AF_UNIX fd as arguments.
     2b. Pyspawner imports modules in its main (and only) thread.
     3b. Pyspawner calls socket.fromfd(), establishing a socket connection. It
         waits for messages from parent.
@@ -186,9 +230,7 @@ def pyspawner_main(_child_main: str, preload_imports_str: str, socket_fd: int) -
     """
     # Load the function we'll call in clone() children
     global child_main
-    child_main_module_name, child_main_name = _child_main.rsplit(".", 1)
-    child_main_module = importlib.import_module(child_main_module_name)
-    child_main = child_main_module.__dict__[child_main_name]
+    child_main = _import_child_main(_child_main)
 
     # 2b. Pyspawner imports modules in its main (and only) thread
     for im in preload_imports_str.split(","):
@@ -204,15 +246,14 @@ def pyspawner_main(_child_main: str, preload_imports_str: str, socket_fd: int) -
     #
     # (As a rule, pyspawner shouldn't use try/finally or context managers.)
     global sock  # see GLOBAL VARIABLES comment
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, fileno=socket_fd)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, fileno=socket_fd)
+    sock.setblocking(True)
 
     while True:
         # 4a. Parent sends a message with spawn parameters.
         global message  # see GLOBAL VARIABLES comment
-        try:
-            # raise EOFError, RuntimeError
-            message = protocol.SpawnChild.recv_on_socket(sock)
-        except EOFError:
+        message = protocol.SpawnChild.recv_on_socket(sock)  # raise ProtocolError
+        if message is None:
             # shutdown: client closed its connection
             return
 
@@ -3,19 +3,44 @@ Communications between parent and pyspawner.
 
 We assume trust between these two processes. (The SpawnChild message is
 transmitted in Python's pickle format.)
+
+The socket is SOCK_STREAM, so SpawnChild carries explicit lengths. We don't
+use SOCK_SEQPACKET, even though it preserves message boundaries: a record
+can be no larger than the socket's send buffer (usually ~200kb, and
+unprivileged processes can't raise it past `net.core.wmem_max`), and `args`
+may be arbitrarily large. Splitting large messages across records would need
+framing of its own. The fixed-size SpawnedChild reply doesn't need framing
+anyway: one `recvmsg(MSG_WAITALL)` reads it.
 """
 from __future__ import annotations
 
 import array
+import functools
+import io
+import os
 import pickle
 import socket
+import struct
+import threading
 from dataclasses import dataclass
-from multiprocessing.reduction import recvfds, sendfds
-from typing import Any, List
+from typing import Any, List, Optional, Tuple
 
 from .sandbox import NetworkConfig, SandboxConfig
 
-__all__ = ["NetworkConfig", "SandboxConfig", "SpawnChild", "SpawnedChild"]
+__all__ = [
+    "ChildArgs",
+    "NetworkConfig",
+    "ProtocolError",
+    "SandboxConfig",
+    "SpawnChild",
+    "SpawnedChild",
+]
+
+
+class ProtocolError(RuntimeError):
+    """
+    The other end sent a malformed or truncated message.
+    """
 
 
 class Message:
@@ -27,21 +52,147 @@ class Message:
         raise NotImplementedError
 
 
-def _send_i(sock: socket.socket, i: int) -> None:
-    sock.sendall(array.array("i", [i]).tobytes())
+_SPAWN_CHILD_HEADER = struct.Struct(">IIIIII")
+"""
+Header preceding each SpawnChild: seq, flags, then the lengths of the
+process name, args pickle and sandbox_config pickle, then buffer count.
+
+After the header come `n_buffers` buffer lengths (each a `_BUFFER_LENGTH`);
+then `process_name`, UTF-8-encoded (empty means None); then a pickle of
+`args`; then a pickle of `sandbox_config`; then the out-of-band buffers that
+`args` refers to.
+"""
+
+_BUFFER_LENGTH = struct.Struct(">Q")
+
+_FLAG_MEMFD_OUTPUT = 1
+_FLAG_ARGS_FROM_STDIN = 2
+
+_PICKLE_PROTOCOL = 5
+"""Pickle protocol. 5 is the first that supports out-of-band buffers."""
+
+_SEQ_PID = struct.Struct(">Ii")
+"""SpawnedChild payload (its file descriptors travel as ancillary data)."""
 
+_FDS_ANCBUFSIZE = socket.CMSG_SPACE(3 * array.array("i").itemsize)
+
+_IOV_MAX = os.sysconf("SC_IOV_MAX")
+
+
+def _recv_into(sock: socket.socket, buf: bytearray) -> int:
+    """
+    Fill `buf` from `sock`; return the number of bytes read.
+
+    The return value is less than `len(buf)` only if the socket is closed.
+    """
+    view = memoryview(buf)
+    pos = 0
+    while pos < len(buf):
+        # MSG_WAITALL: usually, one recv() fills the whole buffer
+        n = sock.recv_into(view[pos:], len(buf) - pos, socket.MSG_WAITALL)
+        if n == 0:
+            break
+        pos += n
+    return pos
+
+
+def _readinto_fd(fd: int, buf: bytearray) -> int:
+    """
+    Fill `buf` from file descriptor `fd`; return the number of bytes read.
+
+    The return value is less than `len(buf)` only at end of file.
+    """
+    view = memoryview(buf)
+    pos = 0
+    while pos < len(buf):
+        n = os.readv(fd, [view[pos:]])
+        if n == 0:
+            break
+        pos += n
+    return pos
 
-def _recv_i(sock: socket.socket) -> int:
-    arr = array.array("i")
-    blob = sock.recv(arr.itemsize)
-    if blob == b"":
-        raise EOFError
-    if len(blob) != arr.itemsize:
-        raise RuntimeError(
-            "recv() returned partial length integer. We do not handle this."
+
+def sendmsg_all(sock: socket.socket, chunks: List[Any]) -> None:
+    """
+    Write all of `chunks` (bytes-like objects) to `sock`, without joining them.
+
+    Usually this is one sendmsg() call. Like `sock.sendall()`, this loops if
+    the kernel accepts only part of the data.
+    """
+    views = [memoryview(chunk).cast("B") for chunk in chunks]
+    views = [view for view in views if len(view)]
+    while views:
+        n = sock.sendmsg(views[:_IOV_MAX])
+        while n > 0 and n >= len(views[0]):
+            n -= len(views[0])
+            views.pop(0)
+        if n:
+            views[0] = views[0][n:]
+
+
+def write_all(fd: int, data: bytes) -> None:
+    """
+    Write all of `data` to file descriptor `fd` (a pipe).
+
+    Raise BrokenPipeError if nothing reads the pipe any more.
+    """
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view) :]
+
+
+_thread_local = threading.local()
+
+
+def _dumps_with_buffers(obj: Any) -> Tuple[bytes, List[pickle.PickleBuffer]]:
+    """
+    Pickle `obj`; return the pickle and its out-of-band buffers.
+
+    This is `pickle.dumps(obj, buffer_callback=...)`, except each thread
+    reuses one Pickler and one BytesIO instead of allocating new ones.
+    """
+    try:
+        pickler, bio, buffers = _thread_local.pickler
+    except AttributeError:
+        bio = io.BytesIO()
+        buffers = []
+        pickler = pickle.Pickler(
+            bio, protocol=_PICKLE_PROTOCOL, buffer_callback=buffers.append
         )
-    arr.frombytes(blob)
-    return arr[0]
+        _thread_local.pickler = (pickler, bio, buffers)
+
+    try:
+        pickler.dump(obj)
+        return bio.getvalue(), list(buffers)
+    except BaseException:
+        del _thread_local.pickler  # it may be mid-frame; start afresh next time
+        raise
+    finally:
+        # Don't keep `obj` (or a big pickle of it) alive until the next call
+        pickler.clear_memo()
+        buffers.clear()
+        bio.seek(0)
+        bio.truncate()
+
+
+@functools.lru_cache(maxsize=16)
+def _pickle_hashable_sandbox_config(sandbox_config: SandboxConfig) -> bytes:
+    return pickle.dumps(sandbox_config, protocol=_PICKLE_PROTOCOL)
+
+
+def _pickle_sandbox_config(sandbox_config: SandboxConfig) -> bytes:
+    """
+    Pickle `sandbox_config`, reusing the result for equal configs.
+
+    Callers tend to pass the same SandboxConfig to every `spawn_child()`.
+    SandboxConfig is frozen, so equal configs pickle to equal bytes. But its
+    fields may be unhashable (e.g., a `set` for `skip_sandbox_except`); then
+    we pickle it afresh.
+    """
+    try:
+        return _pickle_hashable_sandbox_config(sandbox_config)
+    except TypeError:
+        return pickle.dumps(sandbox_config, protocol=_PICKLE_PROTOCOL)
 
 
 @dataclass(frozen=True)
@@ -50,6 +201,9 @@ class SpawnChild:
     Tell child to fork(), close this socket, and run child code.
     """
 
+    seq: int
+    """Request number, echoed back in `SpawnedChild.seq`."""
+
     args: List[Any]
     """Arguments to pass to `child_main(*args)`."""
 
@@ -59,43 +213,175 @@ class SpawnChild:
     sandbox_config: SandboxConfig
     """Restrictions to place on the child's abilities."""
 
+    memfd_output: bool = False
+    """If set, stdout and stderr are memfds instead of pipes."""
+
+    args_from_stdin: bool = False
+    """
+    If set, the child ignores `args` and `process_name`. After sandboxing, it
+    reads a `ChildArgs` from stdin instead. (This is a "prewarmed" child.)
+    """
+
+    def encode(self) -> List[Any]:
+        """
+        Serialize this message as a list of bytes-like chunks.
+
+        Send the chunks with `sendmsg_all()`. Large buffers in `args` (for
+        instance, numpy arrays) are not copied into the pickle: they are
+        chunks of their own, sent straight from their memory.
+
+        This is slow-ish (it pickles `args`), so callers should call it before
+        acquiring any lock.
+        """
+        process_name_blob = (self.process_name or "").encode("utf-8")
+        args_blob, buffers = _dumps_with_buffers(self.args)
+        sandbox_config_blob = _pickle_sandbox_config(self.sandbox_config)
+        raw_buffers = [buffer.raw() for buffer in buffers]
+        flags = (_FLAG_MEMFD_OUTPUT if self.memfd_output else 0) | (
+            _FLAG_ARGS_FROM_STDIN if self.args_from_stdin else 0
+        )
+        header = _SPAWN_CHILD_HEADER.pack(
+            self.seq,
+            flags,
+            len(process_name_blob),
+            len(args_blob),
+            len(sandbox_config_blob),
+            len(raw_buffers),
+        )
+        buffer_lengths = b"".join(
+            _BUFFER_LENGTH.pack(len(raw_buffer)) for raw_buffer in raw_buffers
+        )
+        return [
+            header,
+            buffer_lengths,
+            process_name_blob,
+            args_blob,
+            sandbox_config_blob,
+            *raw_buffers,
+        ]
+
     def send_on_socket(self, sock: socket.socket) -> None:
         """
         Write this message to a UNIX socket.
         """
-        blob = pickle.dumps(self)
-        # Send length and then bytes
-        _send_i(sock, len(blob))
-        sock.sendall(blob)
+        sendmsg_all(sock, self.encode())
 
     @classmethod
-    def recv_on_socket(cls, sock: socket.socket) -> SpawnChild:
+    def recv_on_socket(cls, sock: socket.socket) -> Optional[SpawnChild]:
         """
         Read a message of this type from a UNIX socket.
 
         The message must have been sent with `send_on_socket()`.
 
-        Raise EOFError if the socket is closed mid-read.
+        Return None if the socket is closed before the message starts. Raise
+        ProtocolError if the socket is closed mid-message.
         """
-        n_bytes_to_read = _recv_i(sock)
-
-        # there's no sock.recvall(). https://bugs.python.org/issue1103213
-        blobs = []
-        while n_bytes_to_read > 0:
-            # Python docs suggest 4096 as max size:
-            # https://docs.python.org/3/library/socket.html#socket.socket.recv
-            blob = sock.recv(min(4096, n_bytes_to_read))
-            if len(blob) == 0:
-                raise RuntimeError(
-                    "Missing %d bytes reading %r" % (n_bytes_to_read, cls)
+        header = bytearray(_SPAWN_CHILD_HEADER.size)
+        n = _recv_into(sock, header)
+        if n == 0:
+            return None  # shutdown: the other end closed its connection
+        if n != len(header):
+            raise ProtocolError(
+                "Missing %d header bytes reading %r" % (len(header) - n, cls)
+            )
+        (
+            seq,
+            flags,
+            n_process_name_bytes,
+            n_args_bytes,
+            n_sandbox_config_bytes,
+            n_buffers,
+        ) = _SPAWN_CHILD_HEADER.unpack(header)
+
+        n_lengths_bytes = n_buffers * _BUFFER_LENGTH.size
+        n_bytes = (
+            n_lengths_bytes
+            + n_process_name_bytes
+            + n_args_bytes
+            + n_sandbox_config_bytes
+        )
+        blob = bytearray(n_bytes)
+        n = _recv_into(sock, blob)
+        if n != n_bytes:
+            raise ProtocolError("Missing %d bytes reading %r" % (n_bytes - n, cls))
+        view = memoryview(blob)
+        buffers = []
+        for (buffer_length,) in _BUFFER_LENGTH.iter_unpack(view[:n_lengths_bytes]):
+            buffer = bytearray(buffer_length)
+            n = _recv_into(sock, buffer)
+            if n != buffer_length:
+                raise ProtocolError(
+                    "Missing %d bytes reading %r" % (buffer_length - n, cls)
                 )
-            blobs.append(blob)
-            n_bytes_to_read -= len(blob)
-        blob = b"".join(blobs)
-        retval = pickle.loads(blob)
-        if type(retval) != cls:
-            raise ValueError("Received blob %r; expected type %r" % (retval, cls))
-        return retval
+            buffers.append(buffer)
+        view = view[n_lengths_bytes:]
+        process_name = str(view[:n_process_name_bytes], "utf-8") or None
+        view = view[n_process_name_bytes:]
+        args = pickle.loads(view[:n_args_bytes], buffers=buffers)
+        sandbox_config = pickle.loads(view[n_args_bytes:])
+        if type(sandbox_config) != SandboxConfig:
+            raise ValueError(
+                "Received blob %r; expected type %r" % (sandbox_config, SandboxConfig)
+            )
+        return cls(
+            seq,
+            args,
+            process_name,
+            sandbox_config,
+            memfd_output=bool(flags & _FLAG_MEMFD_OUTPUT),
+            args_from_stdin=bool(flags & _FLAG_ARGS_FROM_STDIN),
+        )
+
+
+@dataclass(frozen=True)
+class ChildArgs:
+    """
+    Tell a prewarmed child what to run, over its stdin.
+
+    The parent writes this to the child's stdin pipe; the child reads it
+    before anything else. The encoding is a `_BUFFER_LENGTH` followed by a
+    pickle of `(process_name, args)`.
+    """
+
+    args: List[Any]
+    """Arguments to pass to `child_main(*args)`."""
+
+    process_name: Optional[str]
+    """Process name to display in 'ps' and server logs."""
+
+    def encode(self) -> bytes:
+        """
+        Serialize this message. Write it with `write_all()`.
+
+        Unlike SpawnChild, this pickles buffers in-band: a pipe has no
+        sendmsg() to send them from their own memory.
+        """
+        blob = pickle.dumps((self.process_name, self.args), protocol=_PICKLE_PROTOCOL)
+        return _BUFFER_LENGTH.pack(len(blob)) + blob
+
+    @classmethod
+    def read_from_fd(cls, fd: int) -> Optional[ChildArgs]:
+        """
+        Read a message of this type from a pipe.
+
+        Return None if the pipe is closed before the message starts. Raise
+        ProtocolError if the pipe is closed mid-message.
+        """
+        header = bytearray(_BUFFER_LENGTH.size)
+        n = _readinto_fd(fd, header)
+        if n == 0:
+            return None  # the parent closed our stdin without using us
+        if n != len(header):
+            raise ProtocolError(
+                "Missing %d header bytes reading %r" % (len(header) - n, cls)
+            )
+        (n_bytes,) = _BUFFER_LENGTH.unpack(header)
+        blob = bytearray(n_bytes)
+        n = _readinto_fd(fd, blob)
+        if n != n_bytes:
+            raise ProtocolError("Missing %d bytes reading %r" % (n_bytes - n, cls))
+        process_name, args = pickle.loads(blob)
+        return cls(args, process_name)
 
 
 @dataclass(frozen=True)
@@ -104,6 +390,7 @@ class SpawnedChild(Message):
     Respond to SpawnChild with a child process's information.
     """
 
+    seq: int
     pid: int
     stdin_fd: int
     stdout_fd: int
@@ -119,18 +406,44 @@ class SpawnedChild(Message):
         descriptors using `sock.sendmsg()`.
         """
 
-        # Send PID
-        _send_i(sock, self.pid)
-        # Now send the file descriptors.
+        # Send seq, PID and file descriptors in a single sendmsg().
         # https://docs.python.org/3/library/socket.html#socket.socket.sendmsg
-        #
-        # It turns out the multiprocessing.reduction module does exactly what
-        # we want.
-        sendfds(sock, [self.stdin_fd, self.stdout_fd, self.stderr_fd])
+        fds = array.array("i", [self.stdin_fd, self.stdout_fd, self.stderr_fd])
+        sock.sendmsg(
+            [_SEQ_PID.pack(self.seq, self.pid)],
+            [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)],
+        )
 
     # override
     @classmethod
-    def recv_on_socket(cls, sock: socket.socket) -> SpawnedChild:
-        pid = _recv_i(sock)
-        stdin_fd, stdout_fd, stderr_fd = recvfds(sock, 3)
-        return cls(pid, stdin_fd, stdout_fd, stderr_fd)
+    def recv_on_socket(cls, sock: socket.socket) -> Optional[SpawnedChild]:
+        """
+        Read a message of this type from a UNIX socket, with one recvmsg().
+
+        Return None if the socket is closed before the message starts. Raise
+        ProtocolError if the message is truncated.
+        """
+        msg, ancdata, flags, _ = sock.recvmsg(
+            _SEQ_PID.size, _FDS_ANCBUFSIZE, socket.MSG_WAITALL
+        )
+        if msg == b"":
+            return None  # shutdown: the other end closed its connection
+        if len(msg) != _SEQ_PID.size:
+            raise ProtocolError(
+                "recvmsg() returned partial seq+PID. We do not handle this."
+            )
+        if flags & socket.MSG_CTRUNC:
+            raise ProtocolError("recvmsg() truncated ancillary data")
+        seq, pid = _SEQ_PID.unpack(msg)
+        fds = array.array("i")
+        for cmsg_level, cmsg_type, cmsg_data in ancdata:
+            if cmsg_level == socket.SOL_SOCKET and cmsg_type == socket.SCM_RIGHTS:
+                fds.frombytes(
+                    cmsg_data[: len(cmsg_data) - (len(cmsg_data) % fds.itemsize)]
+                )
+        if len(fds) != 3:
+            for fd in fds:
+                os.close(fd)
+            raise ProtocolError("Expected 3 file descriptors; got %d" % len(fds))
+        stdin_fd, stdout_fd, stderr_fd = fds
+        return cls(seq, pid, stdin_fd, stdout_fd, stderr_fd)
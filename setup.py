@@ -19,6 +19,7 @@ setup(
     zip_safe=False,
     packages=["pyspawner"],
     package_data={"pyspawner": ["sandbox-seccomp.bpf"]},
+    python_requires=">=3.8",  # pickle protocol 5
     install_requires=["pyroute2~=0.5.7"],
     classifiers=[
         "Development Status :: 4 - Beta",
@@ -26,6 +27,6 @@ setup(
         "Topic :: Software Development :: Libraries :: Python Modules",
         "License :: OSI Approved :: MIT License",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
     ],
 )
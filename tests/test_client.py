@@ -1,20 +1,37 @@
+import atexit
 import contextlib
+import gc
+import itertools
 import os
 import platform
+import selectors
 import shutil
 import socket
 import stat
+import sys
 import tempfile
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from textwrap import dedent
-from typing import Any, ContextManager, FrozenSet, List, Optional, Tuple
+from typing import Any, ContextManager, Dict, FrozenSet, List, Optional, Tuple
+from unittest import mock
 
 import pyspawner
 
 
+def _dedent(code: str) -> str:
+    # Fast path: most snippets are _CODE_* constants, dedented at import
+    first_line = code.lstrip("\n").split("\n", 1)[0]
+    if not first_line.startswith((" ", "\t")):
+        return code
+    return dedent(code)
+
+
 def child_main(indented_code: str) -> None:
-    code = dedent(indented_code)
+    code = _dedent(indented_code)
     code_obj = compile(
         code, "<child_main string>", "exec", dont_inherit=True, optimize=0
     )
@@ -22,34 +39,107 @@ def child_main(indented_code: str) -> None:
     exec(code_obj, globals(), globals())
 
 
+class ChildMains:
+    @staticmethod
+    def echo(message: str) -> None:
+        print(message)
+
+
+def _find_chroot_parent_dir() -> Optional[str]:
+    """
+    Return "/dev/shm" if tests can create chroots there; else None.
+
+    /dev/shm is tmpfs, so creating and deleting chroots costs no disk I/O.
+    But Docker mounts it "noexec", and chroots must allow exec().
+    """
+    try:
+        if not os.statvfs("/dev/shm").f_flag & os.ST_NOEXEC:
+            return "/dev/shm"
+    except FileNotFoundError:
+        pass
+    return None  # tempfile's default
+
+
+_CHROOT_PARENT_DIR = _find_chroot_parent_dir()
+
+
+def _fast_rmtree(path: Path) -> None:
+    """
+    Delete `path` and everything in it, without following symlinks.
+
+    Like shutil.rmtree(), minus the lstat(), open() and fstat() it spends on
+    each directory to guard against symlink races. Nothing races us: no child
+    writes to a test chroot.
+    """
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                _fast_rmtree(entry.path)
+            else:
+                os.unlink(entry.path)
+    os.rmdir(path)
+
+
+_CLIENT_CACHE: Dict[Tuple[Any, ...], pyspawner.Client] = {}
+
+
+def _get_or_create_client(
+    environment: Dict[str, str] = {"LC_CTYPE": "C.UTF-8"}, **kwargs
+) -> pyspawner.Client:
+    """
+    Return a Client running `child_main()`, shared by tests that pass equal args.
+
+    Starting a pyspawner costs a Python startup. The Client stays open until
+    the test process exits. `kwargs` values must be hashable.
+    """
+    key = (tuple(sorted(environment.items())), tuple(sorted(kwargs.items())))
+    try:
+        return _CLIENT_CACHE[key]
+    except KeyError:
+        client = pyspawner.Client(
+            child_main="tests.test_client.child_main",
+            environment=environment,
+            **kwargs,
+        )
+        _CLIENT_CACHE[key] = client
+        return client
+
+
+@atexit.register
+def _close_cached_clients() -> None:
+    for client in _CLIENT_CACHE.values():
+        client.close()
+    _CLIENT_CACHE.clear()
+
+
 @contextlib.contextmanager
 def _spawned_child_context(
     client: pyspawner.Client,
     args: List[Any] = [],
     sandbox_config: pyspawner.SandboxConfig = pyspawner.SandboxConfig(),
 ) -> ContextManager[pyspawner.ChildProcess]:
-    subprocess = client.spawn_child(
+    with client.spawn_child(
         args, process_name="pyspawner-test", sandbox_config=sandbox_config
-    )
-    try:
-        yield subprocess
-    finally:
-        try:
-            subprocess.stdout.read()
-        except ValueError:
-            pass  # stdout already closed
-        try:
-            subprocess.stderr.read()
-        except ValueError:
-            pass  # stderr already closed
-        try:
-            subprocess.kill()
-        except ProcessLookupError:
-            pass
+    ) as subprocess:
         try:
-            subprocess.wait(0)
-        except ChildProcessError:
-            pass
+            yield subprocess
+        finally:
+            try:
+                subprocess.stdout.read()
+            except ValueError:
+                pass  # stdout already closed
+            try:
+                subprocess.stderr.read()
+            except ValueError:
+                pass  # stderr already closed
+            try:
+                subprocess.kill()
+            except ProcessLookupError:
+                pass
+            try:
+                subprocess.wait(0)
+            except ChildProcessError:
+                pass
 
 
 def _spawn_and_communicate(
@@ -73,12 +163,26 @@ def _spawn_and_communicate(
             skip_sandbox_except=skip_sandbox_except,
         ),
     ) as subprocess:
-        subprocess.stdin.write(stdin)
-        subprocess.stdin.close()
-        stdout = subprocess.stdout.read()
-        stderr = subprocess.stderr.read()
-        subprocess.stdout.close()
-        subprocess.stderr.close()
+        subprocess.send_stdin_and_close(stdin)
+        # Read stdout and stderr together: a child blocked writing to one
+        # pipe would never close the other.
+        #
+        # poll(), not epoll: with two fds, epoll's extra syscalls (create, ctl
+        # for each fd, close) outnumber the poll() calls they'd save.
+        output = {subprocess.stdout_fd: bytearray(), subprocess.stderr_fd: bytearray()}
+        buf = memoryview(bytearray(65536))  # reused by every read
+        with selectors.PollSelector() as selector:
+            for fd in output:
+                selector.register(fd, selectors.EVENT_READ)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    n = os.readv(key.fd, [buf])
+                    if n:
+                        output[key.fd] += buf[:n]
+                    else:
+                        selector.unregister(key.fd)
+        stdout = bytes(output[subprocess.stdout_fd])
+        stderr = bytes(output[subprocess.stderr_fd])
         _, status = subprocess.wait(0)
         if os.WIFSIGNALED(status):
             exitcode = -os.WTERMSIG(status)
@@ -104,46 +208,292 @@ def _spawn_and_communicate_or_raise(
         network_config=network_config,
         skip_sandbox_except=skip_sandbox_except,
     )
-    self.assertEqual(exitcode, 0, "Exit code %d: %r" % (exitcode, stderr))
-    self.assertEqual(stderr, b"", "Unexpected stderr: %r" % stderr)
-    self.assertEqual(stdout, b"", "Unexpected stdout: %r" % stdout)
+    assert exitcode == 0, "Exit code %d: %r" % (exitcode, stderr)
+    assert stderr == b"", "Unexpected stderr: %r" % stderr
+    assert stdout == b"", "Unexpected stdout: %r" % stdout
+
+
+def serial(test_method):
+    """
+    Mark a test that must not run concurrently with other tests.
+
+    For instance: a test that creates a child with networking. (Every
+    networked child gets the same interface names.)
+    """
+    test_method.serial = True
+    return test_method
+
+
+class _LockedTestResult:
+    """
+    Proxy a TestResult, so several threads may report to it at once.
+    """
+
+    def __init__(self, result: unittest.TestResult):
+        self._result = result
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._result, name)
+        if not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+
+        return locked
+
+
+class _ConcurrentTestSuite(unittest.TestSuite):
+    """
+    Run the tests of one TestCase class in threads, one test per thread.
+
+    We call the class's setUpClass() and tearDownClass() ourselves, once.
+    Each test spends most of its time in its own child process, so with N
+    CPUs the suite runs up to N times faster.
+    """
+
+    def __init__(self, test_class, tests):
+        super().__init__(tests)
+        self._test_class = test_class
+
+    def run(self, result, debug=False):
+        tests = list(self)
+        if not tests:
+            return result  # don't set up a class no test will use
+        try:
+            self._test_class.setUpClass()
+        except Exception:
+            for test in tests:
+                result.addError(test, sys.exc_info())
+            return result
+        try:
+            locked_result = _LockedTestResult(result)
+            with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                list(executor.map(lambda t: self._run_test(t, locked_result), tests))
+        finally:
+            self._test_class.tearDownClass()
+        return result
+
+    @staticmethod
+    def _run_test(test, result):
+        if not result.shouldStop:  # failfast, or Ctrl-C
+            test(result)
+
+
+# Child code for tests, dedented once (at import) instead of in each child
+_CODE_STDOUT_STDERR = dedent(
+    r"""
+    import os
+    import sys
+    print("stdout")
+    print("stderr", file=sys.stderr)
+    sys.__stdout__.write("__stdout__\n")
+    sys.__stderr__.write("__stderr__\n")
+    os.write(1, b"fd1\n")
+    os.write(2, b"fd2\n")
+    """
+)
+
+_CODE_STDIN = dedent(
+    r"""
+    import sys
+    sys.stdout.write(sys.stdin.read())
+    """
+)
+
+_CODE_PROCESS_NAME = dedent(
+    r"""
+    import ctypes
+    libc = ctypes.CDLL("libc.so.6")
+    name = ctypes.create_string_buffer(16)
+    libc.prctl(16, name, 0, 0, 0)  # PR_GET_NAME
+    print(name.value.decode("utf-8"))
+    """
+)
+
+_CODE_SECURITY_NETWORK_NONE_MEANS_NO_NETWORKING = dedent(
+    r"""
+    import errno
+    import socket
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(("1.1.1.1", 53))
+            assert False, "Connect should not work when network disabled"
+        except OSError as err:
+            assert err.errno == errno.ENETUNREACH
+    """
+)
+
+_CODE_SECURITY_NO_CAPABILITIES = dedent(
+    r"""
+    import ctypes
+    import os
+    libc = ctypes.CDLL("libc.so.6", use_errno=True)
+    PR_CAP_AMBIENT = 47
+    PR_CAP_AMBIENT_IS_SET = 1
+    CAP_SYS_CHROOT = 18  # just one example
+    EPERM = 1
+
+    # Test a capability isn't set
+    assert (
+        libc.prctl(PR_CAP_AMBIENT, PR_CAP_AMBIENT_IS_SET, CAP_SYS_CHROOT, 0, 0)
+    ) == 0
+    # Test we can't actually *use* a capability -- chroot, for example
+
+    try:
+        os.chroot("/")  # raise on error
+        assert False, "chroot worked after dropping capabilities?"
+    except PermissionError:
+        pass
+    """
+)
+
+_CODE_SECURITY_PREVENT_WRITING_UID_MAP = dedent(
+    r"""
+    from pathlib import Path
+
+    def assert_write_fails(path: str, text: str):
+        try:
+            Path(path).write_text(text)
+        except PermissionError:
+            pass
+        else:
+            assert False, "Write to %s should have failed" % path
+
+    assert_write_fails("/proc/self/uid_map", "0 0 65536")
+    assert_write_fails("/proc/self/setgroups", "allow")
+    assert_write_fails("/proc/self/gid_map", "0 0 65536")
+    """
+)
+
+_CODE_SECURITY_CAN_EXEC_BINARIES_IN_CHROOT = dedent(
+    r"""
+    import subprocess
+    result = subprocess.run(["/hello-world"], capture_output=True)
+    assert result.stderr == b"", "program errored %r" % result.stderr
+    assert result.stdout == b"Hello, world!\n", "program output %r" % result.stdout
+    assert result.returncode == 0, "program exited with status code %d" % result.returncode
+    """
+)
+
+_CODE_SECURITY_SETUID = dedent(
+    r"""
+    import os
+    assert os.getuid() == 1000
+    assert os.getgid() == 1000
+    # Assert the script can't setuid() to anything else. In other
+    # words: test we really used setresuid(), not setuid() -- because
+    # setuid() lets you un-setuid() later.
+    try:
+        os.setuid(0); assert False, "gah, how did we setuid to 0?"
+    except PermissionError:
+        pass  # good
+    """
+)
+
+_CODE_SECURITY_SECCOMP = dedent(
+    r"""
+    import os
+    os.setuid(2)
+    """
+)
 
 
 class PyspawnerTest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        cls._client = pyspawner.Client(
-            child_main="tests.test_client.child_main",
+        cls._client = _get_or_create_client(
             environment={"LC_CTYPE": "C.UTF-8", "TEST_ENV": "yes"},
+            # Most tests use the default SandboxConfig: they needn't wait for
+            # a clone(). (When both idle children are taken, tests clone.)
+            prewarm=2,
+        )
+        # One chroot for all tests. Children don't write to it.
+        cls.chroot_dir = Path(
+            tempfile.mkdtemp(prefix="pyspawner-test-chroot-", dir=_CHROOT_PARENT_DIR)
+        )
+        cls.chroot_dir.chmod(0o755)  # so subprocesses can read in their chroots
+        src = "tests/hello-world." + platform.machine()
+        dst = cls.chroot_dir / "hello-world"
+        try:
+            os.link(src, dst)  # no copy at all
+        except OSError:
+            # Different filesystems. copyfile() copies in-kernel (sendfile())
+            shutil.copyfile(src, dst)
+            dst.chmod(0o755)
+        # A service on the host, for test_SECURITY_parent_ip_is_off_limits.
+        # (Port 0: the kernel picks a free port.)
+        cls.host_listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        cls.host_listener.bind((socket.gethostbyname(socket.gethostname()), 0))
+        cls.host_listener.listen(1)
+
+        # test_SECURITY_no_new_privs needs a setuid-root _binary_. (Scripts
+        # invoke the interpreter, which is not setuid.) The "id" binary is
+        # perfect: it prints all three uids and gids if they differ from one
+        # another.
+        assert os.getuid() == 0  # so our test suite can actually chown
+        # Build it in the root filesystem, where there's no "nosetuid" mount
+        # option
+        fd, cls.suid_id_path = tempfile.mkstemp(
+            prefix="print-id", suffix=".bin", dir="/"
         )
+        os.close(fd)
+        shutil.copyfile("/usr/bin/id", cls.suid_id_path)
+        os.chown(cls.suid_id_path, 0, 0)  # make doubly sure root owns it
+        os.chmod(cls.suid_id_path, 0o755 | stat.S_ISUID | stat.S_ISGID)
 
     @classmethod
     def tearDownClass(cls):
-        cls._client.close()
-        del cls._client
+        cls.host_listener.close()
+        del cls.host_listener
+        os.unlink(cls.suid_id_path)
+        del cls.suid_id_path
+        _fast_rmtree(cls.chroot_dir)
+        del cls.chroot_dir
+        del cls._client  # _close_cached_clients() closes it
 
-    def setUp(self):
-        super().setUp()
-        self.chroot_dir = Path(tempfile.mkdtemp(prefix="pyspawner-test-chroot-"))
-        self.chroot_dir.chmod(0o755)  # so subprocesses can read in their chroots
+    def _run_checks_in_child(
+        self,
+        checks: Dict[str, str],
+        chroot_dir: Optional[Path] = None,
+        skip_sandbox_except: FrozenSet[str] = frozenset(),
+    ) -> None:
+        """
+        Run each of `checks` (indented code) in a single child; assert each.
 
-    def tearDown(self):
-        shutil.rmtree(self.chroot_dir)
-        super().tearDown()
+        Checks run in order, each in its own namespace. Failures are reported
+        per check, as subtests.
+        """
+        exitcode, stdout, stderr = _spawn_and_communicate(
+            self._client,
+            r"""
+            for name, code in %r:
+                try:
+                    exec(code, {})
+                except Exception as err:
+                    print("%%s:FAIL:%%r" %% (name, err))
+                else:
+                    print("%%s:OK" %% name)
+            """
+            % [(name, dedent(code)) for name, code in checks.items()],
+            chroot_dir=chroot_dir,
+            skip_sandbox_except=skip_sandbox_except,
+        )
+        self.assertEqual(exitcode, 0, "Exit code %d: %r" % (exitcode, stderr))
+        self.assertEqual(stderr, b"")
+        results = dict(
+            line.split(":", 1) for line in stdout.decode("utf-8").splitlines()
+        )
+        for name in checks:
+            with self.subTest(name):
+                self.assertEqual(results.get(name), "OK")
 
     def test_stdout_stderr(self):
         exitcode, stdout, stderr = _spawn_and_communicate(
             self._client,
-            r"""
-            import os
-            import sys
-            print("stdout")
-            print("stderr", file=sys.stderr)
-            sys.__stdout__.write("__stdout__\n")
-            sys.__stderr__.write("__stderr__\n")
-            os.write(1, b"fd1\n")
-            os.write(2, b"fd2\n")
-            """,
+            _CODE_STDOUT_STDERR,
         )
         self.assertEqual(exitcode, 0)
         self.assertEqual(stdout, b"stdout\n__stdout__\nfd1\n")
@@ -160,71 +510,126 @@ class PyspawnerTest(unittest.TestCase):
     def test_stdin(self):
         exitcode, stdout, stderr = _spawn_and_communicate(
             self._client,
-            r"""
-            import sys
-            sys.stdout.write(sys.stdin.read())
-            """,
+            _CODE_STDIN,
             stdin=b"hello",
         )
         self.assertEqual(stderr, b"")
         self.assertEqual(stdout, b"hello")
         self.assertEqual(exitcode, 0)
 
-    def test_SECURITY_use_environment(self):
-        _spawn_and_communicate_or_raise(
+    def test_raw_fds(self):
+        with _spawned_child_context(
+            self._client, args=["import sys; sys.stdout.write(sys.stdin.read())"]
+        ) as subprocess:
+            os.write(subprocess.stdin_fd, b"hello")
+            subprocess.stdin.close()
+            self.assertEqual(os.read(subprocess.stdout_fd, 10), b"hello")
+            _, status = subprocess.wait(0)
+            self.assertEqual(status, 0)
+
+    def test_send_stdin_and_close_twice(self):
+        with _spawned_child_context(self._client, args=[_CODE_STDIN]) as subprocess:
+            subprocess.send_stdin_and_close(b"hello")
+            with self.assertRaisesRegex(ValueError, "closed file"):
+                subprocess.send_stdin_and_close(b"hello")
+            with self.assertRaisesRegex(ValueError, "closed file"):
+                subprocess.stdin
+            self.assertEqual(subprocess.stdout.read(), b"hello")
+
+    def test_pipes_after_close(self):
+        with _spawned_child_context(self._client, args=[_CODE_STDIN]) as subprocess:
+            subprocess.send_stdin_and_close(b"")
+        # The fd numbers may belong to other files now: don't wrap them
+        r, w = os.pipe()
+        try:
+            for name in ("stdin", "stdout", "stderr"):
+                with self.assertRaisesRegex(ValueError, "closed file"):
+                    getattr(subprocess, name)
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def test_spawn_from_many_threads(self):
+        def spawn(i: int) -> Tuple[int, bytes, bytes]:
+            return _spawn_and_communicate(self._client, "print(%d)" % i)
+
+        with ThreadPoolExecutor(4) as executor:
+            results = list(executor.map(spawn, range(12)))
+        self.assertEqual(results, [(0, b"%d\n" % i, b"") for i in range(12)])
+
+    def test_memfd_output(self):
+        with self._client.spawn_child(
+            [
+                r"""
+                import sys
+                sys.stdout.write("x" * 200000)  # more than a pipe buffer holds
+                sys.stderr.write("err")
+                """
+            ],
+            sandbox_config=pyspawner.SandboxConfig(),
+            memfd_output=True,
+        ) as subprocess:
+            subprocess.stdin.close()
+            _, status = subprocess.wait(0)  # child doesn't block on output
+            self.assertEqual(status, 0)
+            self.assertEqual(subprocess.stdout.read(), b"x" * 200000)
+            self.assertEqual(subprocess.stderr.read(), b"err")
+
+    def test_process_name(self):
+        exitcode, stdout, stderr = _spawn_and_communicate(
             self._client,
-            r"""
-            import os
-            env = dict(os.environ)
-            assert env == {
-                "LC_CTYPE": "C.UTF-8",
-                "TEST_ENV": "yes",
-            }, "Got wrong os.environ: %r" % env
-            """,
+            _CODE_PROCESS_NAME,
         )
+        self.assertEqual(stderr, b"")
+        self.assertEqual(stdout, b"pyspawner-test\n")
 
-    def test_SECURITY_sock_and_any_other_fds_are_closed(self):
-        # The user cannot access pipes or files outside its sandbox (aside from
-        # stdout+stderr, which the parent process knows are untrusted).
-        _spawn_and_communicate_or_raise(
-            self._client,
-            r"""
-            import os
-            for badfd in list(range(3, 20)):
-                try:
-                    os.write(badfd, b"x")
-                    raise RuntimeError("fd %d is unexpectedly open" % badfd)
-                except OSError as err:
-                    assert err.args[0] == 9  # Bad file descriptor
-            """,
+    def test_SECURITY_default_sandbox(self):
+        self._run_checks_in_child(
+            {
+                "use_environment": r"""
+                    import os
+                    env = dict(os.environ)
+                    assert env == {
+                        "LC_CTYPE": "C.UTF-8",
+                        "TEST_ENV": "yes",
+                    }, "Got wrong os.environ: %r" % env
+                    """,
+                # The user cannot access pipes or files outside its sandbox
+                # (aside from stdout+stderr, which the parent process knows are
+                # untrusted).
+                "sock_and_any_other_fds_are_closed": r"""
+                    import os
+                    for badfd in list(range(3, 20)):
+                        try:
+                            os.write(badfd, b"x")
+                            raise RuntimeError("fd %d is unexpectedly open" % badfd)
+                        except OSError as err:
+                            assert err.args[0] == 9  # Bad file descriptor
+                    """,
+            }
         )
 
+    @serial
     def test_SECURITY_parent_ip_is_off_limits(self):
         # The module cannot access a service on its host
-        hostname = socket.gethostname()
-        host_ip = socket.gethostbyname(hostname)
-        port = 19999  # arbitrary
-
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind((host_ip, port))
-            s.listen(1)
-
-            _spawn_and_communicate_or_raise(
-                self._client,
-                r"""
-                import errno
-                import socket
-                try:
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                        s.connect((%r, %r))
-                        assert False, "connect() should have failed"
-                except OSError as err:
-                    assert err.errno == errno.ECONNREFUSED
-                """
-                % (host_ip, port),
-                network_config=pyspawner.NetworkConfig(),
-            )
+        host_ip, port = self.host_listener.getsockname()
+        _spawn_and_communicate_or_raise(
+            self._client,
+            r"""
+            import errno
+            import socket
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                    s.connect((%r, %r))
+                    assert False, "connect() should have failed"
+            except OSError as err:
+                assert err.errno == errno.ECONNREFUSED
+            """
+            % (host_ip, port),
+            network_config=pyspawner.NetworkConfig(),
+        )
 
+    @serial
     def test_SECURITY_private_network_is_off_limits(self):
         # The module cannot access a service on the private network.
         # Try to connect to Postgres -- we know it's there.
@@ -250,16 +655,7 @@ class PyspawnerTest(unittest.TestCase):
     def test_SECURITY_network_none_means_no_networking(self):
         _spawn_and_communicate_or_raise(
             self._client,
-            r"""
-            import errno
-            import socket
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                try:
-                    s.connect(("1.1.1.1", 53))
-                    assert False, "Connect should not work when network disabled"
-                except OSError as err:
-                    assert err.errno == errno.ENETUNREACH
-            """,
+            _CODE_SECURITY_NETWORK_NONE_MEANS_NO_NETWORKING,
             network_config=None,
         )
 
@@ -295,92 +691,41 @@ class PyspawnerTest(unittest.TestCase):
         # restricts syscalls that might leak outside the container.
         _spawn_and_communicate_or_raise(
             self._client,
-            r"""
-            import ctypes
-            import os
-            libc = ctypes.CDLL("libc.so.6", use_errno=True)
-            PR_CAP_AMBIENT = 47
-            PR_CAP_AMBIENT_IS_SET = 1
-            CAP_SYS_CHROOT = 18  # just one example
-            EPERM = 1
-
-            # Test a capability isn't set
-            assert (
-                libc.prctl(PR_CAP_AMBIENT, PR_CAP_AMBIENT_IS_SET, CAP_SYS_CHROOT, 0, 0)
-            ) == 0
-            # Test we can't actually *use* a capability -- chroot, for example
-
-            try:
-                os.chroot("/")  # raise on error
-                assert False, "chroot worked after dropping capabilities?"
-            except PermissionError:
-                pass
-            """,
+            _CODE_SECURITY_NO_CAPABILITIES,
             skip_sandbox_except=frozenset(["drop_capabilities"]),
         )
 
     def test_SECURITY_prevent_writing_uid_map(self):
         _spawn_and_communicate_or_raise(
             self._client,
-            r"""
-            from pathlib import Path
-
-            def assert_write_fails(path: str, text: str):
-                try:
-                    Path(path).write_text(text)
-                except PermissionError:
-                    pass
-                else:
-                    assert False, "Write to %s should have failed" % path
-
-            assert_write_fails("/proc/self/uid_map", "0 0 65536")
-            assert_write_fails("/proc/self/setgroups", "allow")
-            assert_write_fails("/proc/self/gid_map", "0 0 65536")
-            """,
+            _CODE_SECURITY_PREVENT_WRITING_UID_MAP,
             # There's no way to disable this security feature. But for testing
             # we must _disable_ setuid and chroot; so write a dummy
             # skip_sandbox_except to accomplish that.
             skip_sandbox_except=frozenset(["skip_all_optional_sandboxing"]),
         )
 
-    def test_SECURITY_chroot_has_no_proc_dir(self):
-        _spawn_and_communicate_or_raise(
-            self._client,
-            r"""
-            import os
-
-            assert not os.path.exists("/proc"), "/proc should not be accessible"
-            assert not os.path.exists("/sys"), "/sys should not be accessible"
-            """,
-            chroot_dir=self.chroot_dir,
-            skip_sandbox_except=frozenset(["none"]),
-        )
-
-    def test_SECURITY_chroot_ensures_cwd_is_under_root(self):
-        _spawn_and_communicate_or_raise(
-            self._client,
-            r"""
-            import os
-
-            assert os.getcwd() == "/"
-            """,
+    def test_SECURITY_chroot(self):
+        self._run_checks_in_child(
+            {
+                "has_no_proc_dir": r"""
+                    import os
+                    assert not os.path.exists("/proc"), "/proc is accessible"
+                    assert not os.path.exists("/sys"), "/sys is accessible"
+                    """,
+                "ensures_cwd_is_under_root": r"""
+                    import os
+                    assert os.getcwd() == "/"
+                    """,
+            },
             chroot_dir=self.chroot_dir,
             skip_sandbox_except=frozenset(["none"]),
         )
 
     def test_SECURITY_can_exec_binaries_in_chroot(self):
-        arch = platform.machine()
-        shutil.copy2("tests/hello-world." + arch, self.chroot_dir / "hello-world")
-
         _spawn_and_communicate_or_raise(
             self._client,
-            r"""
-            import subprocess
-            result = subprocess.run(["/hello-world"], capture_output=True)
-            assert result.stderr == b"", "program errored %r" % result.stderr
-            assert result.stdout == b"Hello, world!\n", "program output %r" % result.stdout
-            assert result.returncode == 0, "program exited with status code %d" % result.returncode
-            """,
+            _CODE_SECURITY_CAN_EXEC_BINARIES_IN_CHROOT,
             chroot_dir=self.chroot_dir,
             skip_sandbox_except=frozenset(["none"]),
         )
@@ -394,18 +739,7 @@ class PyspawnerTest(unittest.TestCase):
         # to set EPERM.)
         _spawn_and_communicate_or_raise(
             self._client,
-            r"""
-            import os
-            assert os.getuid() == 1000
-            assert os.getgid() == 1000
-            # Assert the script can't setuid() to anything else. In other
-            # words: test we really used setresuid(), not setuid() -- because
-            # setuid() lets you un-setuid() later.
-            try:
-                os.setuid(0); assert False, "gah, how did we setuid to 0?"
-            except PermissionError:
-                pass  # good
-            """,
+            _CODE_SECURITY_SETUID,
             chroot_dir=self.chroot_dir,
             skip_sandbox_except=frozenset(["setuid", "drop_capabilities"]),
         )
@@ -418,10 +752,7 @@ class PyspawnerTest(unittest.TestCase):
         # thing protecting us from setuid.
         exitcode, stdout, stderr = _spawn_and_communicate(
             self._client,
-            r"""
-            import os
-            os.setuid(2)
-            """,
+            _CODE_SECURITY_SECCOMP,
             chroot_dir=self.chroot_dir,
             skip_sandbox_except=frozenset(["seccomp", "no_new_privs"]),
         )
@@ -429,50 +760,285 @@ class PyspawnerTest(unittest.TestCase):
 
     def test_SECURITY_no_new_privs(self):
         # The user cannot use a setuid program to become root
-        assert os.getuid() == 0  # so our test suite can actually chmod
-        # Build the tempfile in the root filesystem, where there's no
-        # "nosetuid" mount option
-        with tempfile.NamedTemporaryFile(
-            prefix="print-id", suffix=".bin", dir="/"
-        ) as prog:
-            prog.close()
-            # We can't test with a _script_: we need to test with a _binary_.
-            # (Scripts invoke the interpreter, which is not setuid.)
-            #
-            # The "id" binary is perfect: it prints all three uids and gids if
-            # they differ from one another.
-            shutil.copy("/usr/bin/id", prog.name)
-            os.chown(prog.name, 0, 0)  # make doubly sure root owns it
-            os.chmod(prog.name, 0o755 | stat.S_ISUID | stat.S_ISGID)
-            exitcode, stdout, stderr = _spawn_and_communicate(
-                self._client,
-                r"""
-                import os
-                os.execv(%r, [%r])
-                """
-                % (prog.name, prog.name),
-                # XXX SECURITY [2019-10-11] This test should fail if we comment
-                # out "no_new_privs". Why doesn't it? (It looks like there's
-                # some other security layer we don't know of....)
-                skip_sandbox_except=frozenset(["setuid", "no_new_privs"]),
-            )
-            if stderr:
-                assert False, stderr
-            self.assertEqual(exitcode, 0)
-            self.assertEqual(stdout, b"uid=1000 gid=1000 groups=1000\n")
+        exitcode, stdout, stderr = _spawn_and_communicate(
+            self._client,
+            r"""
+            import os
+            os.execv(%r, [%r])
+            """
+            % (self.suid_id_path, self.suid_id_path),
+            # XXX SECURITY [2019-10-11] This test should fail if we comment
+            # out "no_new_privs". Why doesn't it? (It looks like there's
+            # some other security layer we don't know of....)
+            skip_sandbox_except=frozenset(["setuid", "no_new_privs"]),
+        )
+        if stderr:
+            assert False, stderr
+        self.assertEqual(exitcode, 0)
+        self.assertEqual(stdout, b"uid=1000 gid=1000 groups=1000\n")
+
+
+_CODE_EXECUTABLE = dedent(
+    r"""
+    import sys
+    assert sys.executable == "/usr/bin/python3.8"
+    """
+)
+
+_CODE_PRELOAD_IMPORTS = dedent(
+    r"""
+    import sys
+    assert "email.mime.text" in sys.modules
+    assert "json" in sys.modules
+    """
+)
 
 
 class ClientTest(unittest.TestCase):
+    def test_SECURITY_inherited_fds_are_closed(self):
+        read_fd, write_fd = os.pipe()
+        try:
+            os.set_inheritable(write_fd, True)  # as if our caller leaked it
+            with pyspawner.Client(
+                child_main="tests.test_client.child_main",
+                environment={"LC_CTYPE": "C.UTF-8"},
+            ) as client:
+                exitcode, stdout, stderr = _spawn_and_communicate(
+                    client,
+                    r"""
+                    import os
+                    try:
+                        os.write(%d, b"x")
+                        raise RuntimeError("inherited fd is open")
+                    except OSError as err:
+                        assert err.args[0] == 9  # Bad file descriptor
+                    """
+                    % write_fd,
+                )
+                self.assertEqual(stderr, b"")
+                self.assertEqual(exitcode, 0)
+        finally:
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def test_SECURITY_control_socket_is_not_inheritable(self):
+        # Another thread may spawn a process while we launch the pyspawner. If
+        # that process inherited the socket, the pyspawner's EOF would never
+        # reach us.
+        posix_spawnp = os.posix_spawnp
+        inheritable = []
+
+        def check_posix_spawnp(path, argv, env, *, file_actions, **kwargs):
+            for action in file_actions:
+                if action[0] == os.POSIX_SPAWN_DUP2 and action[2] == 3:
+                    inheritable.append(os.get_inheritable(action[1]))
+            return posix_spawnp(path, argv, env, file_actions=file_actions, **kwargs)
+
+        with mock.patch.object(os, "posix_spawnp", check_posix_spawnp):
+            with pyspawner.Client(
+                child_main="tests.test_client.ChildMains.echo",
+                environment={"LC_CTYPE": "C.UTF-8"},
+            ) as client:
+                exitcode, stdout, stderr = _spawn_and_communicate(client, "hi")
+        self.assertEqual(inheritable, [False])
+        self.assertEqual(stdout, b"hi\n")
+
     def test_executable(self):
+        client = _get_or_create_client(executable="/usr/bin/python3.8")
+        _spawn_and_communicate_or_raise(client, _CODE_EXECUTABLE)
+
+    def test_preload_imports(self):
         with pyspawner.Client(
             child_main="tests.test_client.child_main",
             environment={"LC_CTYPE": "C.UTF-8"},
-            executable="/usr/bin/python3.8",
+            preload_imports=["email.mime.text", "json", "email"],
         ) as client:
-            _spawn_and_communicate_or_raise(
-                self._client,
-                r"""
-                import sys
-                assert sys.executable == "/usr/bin/python3.8"
-                """,
+            exitcode, stdout, stderr = _spawn_and_communicate(
+                client,
+                _CODE_PRELOAD_IMPORTS,
+            )
+            self.assertEqual(stderr, b"")
+            self.assertEqual(exitcode, 0)
+
+    def test_disable_process_names(self):
+        with pyspawner.Client(
+            child_main="tests.test_client.child_main",
+            environment={"LC_CTYPE": "C.UTF-8"},
+            enable_process_names=False,
+        ) as client:
+            exitcode, stdout, stderr = _spawn_and_communicate(
+                client,
+                _CODE_PROCESS_NAME,
             )
+            self.assertEqual(stderr, b"")
+            self.assertNotEqual(stdout, b"pyspawner-test\n")
+
+    def test_child_main_attribute_path(self):
+        with pyspawner.Client(
+            child_main="tests.test_client.ChildMains.echo",
+            environment={"LC_CTYPE": "C.UTF-8"},
+        ) as client:
+            exitcode, stdout, stderr = _spawn_and_communicate(client, "hello")
+            self.assertEqual(stderr, b"")
+            self.assertEqual(stdout, b"hello\n")
+
+    def test_seq_wraps_around(self):
+        with pyspawner.Client(
+            child_main="tests.test_client.ChildMains.echo",
+            environment={"LC_CTYPE": "C.UTF-8"},
+        ) as client:
+            client._seqs = itertools.count(2 ** 32 - 1)  # as if long-lived
+            for message in ("before", "after"):
+                exitcode, stdout, stderr = _spawn_and_communicate(client, message)
+                self.assertEqual(stderr, b"")
+                self.assertEqual(stdout, message.encode("utf-8") + b"\n")
+
+    def test_garbage_collected_without_close(self):
+        client = pyspawner.Client(
+            child_main="tests.test_client.ChildMains.echo",
+            environment={"LC_CTYPE": "C.UTF-8"},
+            prewarm=1,
+        )
+        _wait_for_prewarmed_children(client, 1)
+        process = client._process
+        prewarmed_pid = client._prewarmed[0].pid
+        threads = [
+            client._writer_thread,
+            client._reader_thread,
+            client._prewarm_thread,
+        ]
+        del client
+        gc.collect()
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+        self.assertEqual(process.wait(), 0)  # the pyspawner exited
+        os.waitpid(prewarmed_pid, 0)  # the idle child exited
+
+    def test_prewarm(self):
+        with pyspawner.Client(
+            child_main="tests.test_client.child_main",
+            environment={"LC_CTYPE": "C.UTF-8"},
+            prewarm=2,
+        ) as client, _count_clones(client) as clones:
+            for i in range(3):  # more than `prewarm`: wait for refills
+                _wait_for_prewarmed_children(client, 2)
+                exitcode, stdout, stderr = _spawn_and_communicate(
+                    client,
+                    _CODE_PROCESS_NAME + _CODE_STDIN,
+                    stdin=b"stdin %d" % i,
+                )
+                self.assertEqual(stderr, b"")
+                self.assertEqual(stdout, b"pyspawner-test\nstdin %d" % i)
+                self.assertEqual(exitcode, 0)
+            self.assertEqual(clones, [])  # every child came from the pool
+
+    def test_prewarm_args_that_import(self):
+        # Fraction's pickle imports "fractions". A prewarmed child can't: it
+        # unpickles in its (empty) chroot. So spawn_child() must clone.
+        #
+        # Import here, not at the top: the pyspawner imports this module, and
+        # we need a module it hasn't imported.
+        from fractions import Fraction
+
+        chroot_dir = Path(tempfile.mkdtemp(dir=_CHROOT_PARENT_DIR))
+        try:
+            chroot_dir.chmod(0o755)
+            sandbox_config = pyspawner.SandboxConfig(chroot_dir=chroot_dir)
+            with pyspawner.Client(
+                child_main="tests.test_client.ChildMains.echo",
+                environment={"LC_CTYPE": "C.UTF-8"},
+                prewarm=1,
+                prewarm_sandbox_config=sandbox_config,
+            ) as client, _count_clones(client) as clones:
+                _wait_for_prewarmed_children(client, 1)
+                with _spawned_child_context(
+                    client, [Fraction(1, 2)], sandbox_config=sandbox_config
+                ) as subprocess:
+                    subprocess.send_stdin_and_close(b"")
+                    self.assertEqual(subprocess.stdout.read(), b"1/2\n")
+                    self.assertEqual(subprocess.stderr.read(), b"")
+                self.assertEqual(len(clones), 1)
+        finally:
+            _fast_rmtree(chroot_dir)
+
+    def test_prewarm_recursive_args(self):
+        # Checking args must not recurse forever. (Clone: it's always safe.)
+        recursive_list = []
+        recursive_list.append(recursive_list)
+        with pyspawner.Client(
+            child_main="tests.test_client.ChildMains.echo",
+            environment={"LC_CTYPE": "C.UTF-8"},
+            prewarm=1,
+        ) as client, _count_clones(client) as clones:
+            _wait_for_prewarmed_children(client, 1)
+            with _spawned_child_context(client, [recursive_list]) as subprocess:
+                subprocess.send_stdin_and_close(b"")
+                self.assertEqual(subprocess.stdout.read(), b"[[...]]\n")
+                self.assertEqual(subprocess.stderr.read(), b"")
+            self.assertEqual(len(clones), 1)
+
+    def test_prewarm_network_config(self):
+        with self.assertRaisesRegex(ValueError, "networking"):
+            pyspawner.Client(
+                child_main="tests.test_client.child_main",
+                prewarm=1,
+                prewarm_sandbox_config=pyspawner.SandboxConfig(
+                    network=pyspawner.NetworkConfig()
+                ),
+            )
+
+
+def _wait_for_prewarmed_children(client: pyspawner.Client, n: int) -> None:
+    deadline = time.monotonic() + 10
+    while len(client._prewarmed) < n:
+        assert time.monotonic() < deadline, "Client did not prewarm children"
+        time.sleep(0.005)
+
+
+@contextlib.contextmanager
+def _count_clones(client: pyspawner.Client) -> ContextManager[List[Any]]:
+    """
+    Yield a list of the `args` of each child `client` clones for a caller.
+
+    (Clones that refill `client`'s pool of prewarmed children don't count.)
+    """
+    clones = []
+    spawn = client._spawn
+
+    def spy(**kwargs):
+        if not kwargs["args_from_stdin"]:
+            clones.append(kwargs["args"])
+        return spawn(**kwargs)
+
+    with mock.patch.object(client, "_spawn", spy):
+        yield clones
+
+
+def _iter_tests(suite: unittest.TestSuite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            yield from _iter_tests(test)
+        else:
+            yield test
+
+
+def load_tests(loader, standard_tests, pattern):
+    """
+    Run PyspawnerTest's tests concurrently, except those marked `@serial`.
+
+    Run all other tests as usual, afterwards.
+    """
+    concurrent_tests = []
+    other_tests = []
+    for test in _iter_tests(standard_tests):
+        if isinstance(test, PyspawnerTest) and not getattr(
+            getattr(test, test._testMethodName), "serial", False
+        ):
+            concurrent_tests.append(test)
+        else:
+            other_tests.append(test)
+    suites = [unittest.TestSuite(other_tests)]
+    if concurrent_tests:
+        suites.insert(0, _ConcurrentTestSuite(PyspawnerTest, concurrent_tests))
+    return unittest.TestSuite(suites)
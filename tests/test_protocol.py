@@ -0,0 +1,85 @@
+import pickle
+import socket
+import threading
+import unittest
+from pathlib import Path
+
+from pyspawner import protocol
+
+
+class SpawnChildTest(unittest.TestCase):
+    def _send_and_recv(self, message: protocol.SpawnChild) -> protocol.SpawnChild:
+        a, b = socket.socketpair(socket.AF_UNIX)
+        with a, b:
+            # Send from another thread: big messages fill the socket buffer
+            thread = threading.Thread(target=message.send_on_socket, args=(a,))
+            thread.start()
+            try:
+                return protocol.SpawnChild.recv_on_socket(b)
+            finally:
+                thread.join()
+
+    def test_round_trip(self):
+        message = protocol.SpawnChild(
+            seq=3,
+            args=["x", 1],
+            process_name="child",
+            sandbox_config=protocol.SandboxConfig(chroot_dir=Path("/tmp")),
+        )
+        self.assertEqual(self._send_and_recv(message), message)
+
+    def test_unhashable_sandbox_config(self):
+        message = protocol.SpawnChild(
+            seq=3,
+            args=[],
+            process_name=None,
+            sandbox_config=protocol.SandboxConfig(skip_sandbox_except={"setuid"}),
+        )
+        self.assertEqual(self._send_and_recv(message), message)
+
+    def test_out_of_band_buffers(self):
+        big = bytearray(b"x" * 3_000_000)
+        message = protocol.SpawnChild(
+            seq=4,
+            args=[big, bytearray(b""), bytearray(b"y")],
+            process_name=None,
+            sandbox_config=protocol.SandboxConfig(),
+        )
+        self.assertEqual(self._send_and_recv(message), message)
+
+    def test_unpicklable_args_do_not_break_next_message(self):
+        message = protocol.SpawnChild(
+            seq=5,
+            args=[lambda: None],
+            process_name=None,
+            sandbox_config=protocol.SandboxConfig(),
+        )
+        with self.assertRaises((pickle.PicklingError, AttributeError)):
+            message.encode()
+        message = protocol.SpawnChild(
+            seq=6,
+            args=["ok"],
+            process_name=None,
+            sandbox_config=protocol.SandboxConfig(),
+        )
+        self.assertEqual(self._send_and_recv(message), message)
+
+    def test_recv_clean_eof_returns_none(self):
+        a, b = socket.socketpair(socket.AF_UNIX)
+        with a, b:
+            a.close()
+            self.assertIsNone(protocol.SpawnChild.recv_on_socket(b))
+
+    def test_recv_truncated_message_raises_protocol_error(self):
+        message = protocol.SpawnChild(
+            seq=7,
+            args=["x"],
+            process_name=None,
+            sandbox_config=protocol.SandboxConfig(),
+        )
+        a, b = socket.socketpair(socket.AF_UNIX)
+        with a, b:
+            a.sendall(b"".join(bytes(chunk) for chunk in message.encode())[:-1])
+            a.close()
+            with self.assertRaises(protocol.ProtocolError):
+                protocol.SpawnChild.recv_on_socket(b)